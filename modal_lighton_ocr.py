@@ -6,6 +6,19 @@ import modal
 
 MODEL_ID = "lightonai/LightOnOCR-1B-1025"
 N_GPU = 1
+GPU = "A100-40GB"  # A100 40GB (40GB, 1555 GB/s)
+# Recommended --max-num-seqs per GPU, scaled with available KV-cache memory
+MAX_NUM_SEQS_BY_GPU = {
+    "T4": 256,
+    "L4": 512,
+    "A10": 512,
+    "L40S": 2048,
+    "A100-40GB": 1024,
+    "A100-80GB": 4096,
+    "H100": 4096,
+    "H200": 8192,
+    "B200": 12288,
+}
 VLLM_PORT = 8000
 # Default to False for better steady-state throughput (enables compilation + cudagraphs)
 FAST_BOOT = os.environ.get("FAST_BOOT", "false").lower() == "true"
@@ -54,10 +67,64 @@ image = (
 
 app = modal.App("lighton-ocr-vllm")
 
+# 32x32 white PNG, just enough to exercise the vision encoder during warmup
+WARMUP_IMAGE_B64 = "iVBORw0KGgoAAAANSUhEUgAAACAAAAAgCAIAAAD8GO2jAAAAJklEQVR42u3NMQ0AAAwDoPo33arYsQQMkB6LQCAQCAQCgUAg+BIMi1X0ptsIcT0AAAAASUVORK5CYII="
+
+
+# Runtime-step: block until vLLM answers one tiny request
+def warmup_server(process, model_id: str, timeout: float = 9 * 60) -> None:
+    import json
+    import time
+    import urllib.request
+
+    base_url = f"http://127.0.0.1:{VLLM_PORT}"
+    deadline = time.time() + timeout
+
+    # Wait for vLLM to come up (or give up if it crashed)
+    while time.time() < deadline:
+        if process.poll() is not None:
+            print(f"vLLM exited with code {process.returncode}, skipping warmup")
+            return
+        try:
+            with urllib.request.urlopen(f"{base_url}/health", timeout=5) as response:
+                if response.status == 200:
+                    break
+        except OSError:
+            pass
+        time.sleep(2)
+    else:
+        print("vLLM not healthy before warmup deadline, skipping warmup")
+        return
+
+    payload = {
+        "model": model_id,
+        "messages": [{
+            "role": "user",
+            "content": [{
+                "type": "image_url",
+                "image_url": {"url": f"data:image/png;base64,{WARMUP_IMAGE_B64}"}
+            }]
+        }],
+        "max_tokens": 1,
+    }
+    request = urllib.request.Request(
+        f"{base_url}/v1/chat/completions",
+        data=json.dumps(payload).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    start = time.time()
+    try:
+        with urllib.request.urlopen(request, timeout=max(deadline - time.time(), 1)) as response:
+            response.read()
+        print(f"Warmup request finished in {time.time() - start:.1f}s")
+    except OSError as e:
+        # Warmup is best-effort; the server still starts serving
+        print(f"Warmup request failed: {e}")
+
 
 @app.function(
     image=image,
-    gpu="A100-40GB:1",  # A100 40GB (40GB, 1555 GB/s)
+    gpu=f"{GPU}:{N_GPU}",
     scaledown_window=15 * 60,  # Stay warm for 15 minutes
     timeout=10 * 60,  # 10 minute timeout
     volumes={
@@ -72,6 +139,7 @@ def serve():
     import os
 
     model_id = os.environ.get("MODEL_ID", MODEL_ID)
+    max_num_seqs = MAX_NUM_SEQS_BY_GPU.get(GPU, 1024)
 
     cmd = [
         "vllm",
@@ -89,12 +157,19 @@ def serve():
         "--gpu-memory-utilization",
         "0.90",
         "--max-num-seqs",
-        "1024",  # A100-40GB can handle large batches with 40GB memory
+        str(max_num_seqs),
         "--limit-mm-per-prompt",
         '{"image": 1}',  # Vision model: one image per request
         # Removed --async-scheduling due to known bugs with vision models causing crashes
         "--tensor-parallel-size",
         str(N_GPU),
+        # Requests share the chat template prefix, so reuse its KV cache
+        "--enable-prefix-caching",
+        # Split long vision prefills so they batch with decodes (smoother tail latency)
+        "--enable-chunked-prefill",
+        # vLLM requires max_num_batched_tokens >= max_num_seqs
+        "--max-num-batched-tokens",
+        str(max(8192, max_num_seqs)),
     ]
 
     # enforce-eager disables CUDA graphs and Torch compilation
@@ -103,4 +178,8 @@ def serve():
 
     # Avoid shell=True for proper arg handling
     print("Launching vLLM:", " ".join(cmd))
-    subprocess.Popen(cmd)
+    process = subprocess.Popen(cmd)
+
+    # Modal only routes traffic once serve() returns, so warming up here keeps
+    # the first real request from paying for lazy init and graph capture
+    warmup_server(process, model_id)